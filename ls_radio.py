@@ -5,24 +5,34 @@ ls_radio.py — SQLite-backed picker + history for Liquidsoap.
 Subcommands:
   pick-next         -> prints a path (or empty string) to stdout and exits.
   track-start       -> record actual on-air start times; args: --artist --title --path
-  rebuild-cache     -> force cache rebuild now (runs in-foreground)
+  rebuild-cache     -> force cache rebuild now (runs in-foreground); --full re-reads
+                       every file's tags, --release-lock drops the builder lock
+                       taken by pick-next
   init              -> create DB schema if missing
   vacuum            -> sqlite VACUUM
 
 Environment vars (see systemd unit for defaults):
   LS_DB, LS_MUSIC_DIR, LS_RESCAN_SEC, LS_LOCK_STALE_SEC,
   LS_ARTIST_SEP_MIN, LS_TITLE_SEP_MIN, LS_TRACK_SEP_SEC,
-  LS_FFPROBE_TIMEOUT_S, LS_SCAN_EXTS, LS_UNKNOWN_ARTIST_BUCKET,
+  LS_FFPROBE_TIMEOUT_S, LS_FFPROBE_WORKERS, LS_SCAN_EXTS, LS_UNKNOWN_ARTIST_BUCKET,
   LS_HISTORY_KEEP, LS_HISTORY_KEEP_PATHS,
-  LS_TOP_N_DIRS, LS_FILES_PER_DIR_TRY,
+  LS_TOP_N_DIRS,
   LS_EVERGREEN_DIR, LS_SLOT_PRE_SEC, LS_SLOT_POST_SEC
 """
 
-import os, sys, time, json, random, pathlib, subprocess, tempfile, argparse, atexit, signal, sqlite3, re, unicodedata
+import os, sys, time, json, random, pathlib, subprocess, tempfile, argparse, atexit, signal, sqlite3, re, unicodedata, queue
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from mutagen import File as MutagenFile  # optional: in-process tag reads, no ffprobe spawn
+    from mutagen.id3 import ID3 as MutagenID3
+except ImportError:
+    MutagenFile = MutagenID3 = None
 
 # ------------- ENV -------------
 DB_PATH     = os.environ.get("LS_DB", "/var/lib/liquidsoap/liquidsoap.db")
 MUSIC_DIR   = os.environ.get("LS_MUSIC_DIR", "/srv/music")
+CACHE_STAMP = DB_PATH + ".stamp"  # touched after each rebuild; mtime = cache age
 
 RE_SCAN_SEC = int(os.environ.get("LS_RESCAN_SEC", "86400"))
 LOCK_STALE  = int(os.environ.get("LS_LOCK_STALE_SEC", "3600"))
@@ -32,15 +42,18 @@ TITLE_SEP   = int(os.environ.get("LS_TITLE_SEP_MIN",  "180")) * 60
 TRACK_SEP   = int(os.environ.get("LS_TRACK_SEP_SEC",  "0"))
 
 FFPROBE_TIMEOUT = float(os.environ.get("LS_FFPROBE_TIMEOUT_S", "0.8"))
+FFPROBE_WORKERS = int(os.environ.get("LS_FFPROBE_WORKERS", str(min(32, (os.cpu_count() or 1) * 2))))
+SCAN_QUEUE      = 1024  # scanned paths buffered ahead of the tag workers
+INSERT_BATCH    = min(5000, 32766 // 7)  # rows per executemany; 7 bound params per row
 UNKNOWN_ARTIST_BUCKET = os.environ.get("LS_UNKNOWN_ARTIST_BUCKET", "1") == "1"
 
 HISTORY_KEEP        = int(os.environ.get("LS_HISTORY_KEEP", "10000"))
 HISTORY_KEEP_PATHS  = int(os.environ.get("LS_HISTORY_KEEP_PATHS", "20000"))
 
 SCAN_EXTS = set(e.strip().lower() for e in os.environ.get("LS_SCAN_EXTS",".mp3,.flac,.m4a,.ogg,.wav,.aac").split(","))
+SCAN_EXTS_NOSEP = {e.lstrip(".") for e in SCAN_EXTS}
 
 TOP_N_DIRS        = int(os.environ.get("LS_TOP_N_DIRS", "64"))
-FILES_PER_DIR_TRY = int(os.environ.get("LS_FILES_PER_DIR_TRY", "128"))
 
 # Evergreen / scheduled content
 # Drop audio files into LS_EVERGREEN_DIR to have one played automatically
@@ -55,13 +68,20 @@ random.seed(time.time_ns())
 # ------------- UTIL -------------
 def now_ts(): return time.time()
 
+_KEYNORM_RE = re.compile(r"[\W_]+")
+_KEYNORM_ASCII_DEL = bytes(c for c in range(128) if not chr(c).isalnum())
+
 def key_norm(s: str) -> str:
     s = (s or "").strip().lower()
     s = unicodedata.normalize("NFKD", s)
-    return re.sub(r"[\W_]+", "", s)
+    if s.isascii():
+        # same result as the regex, but one C-level pass over bytes
+        return s.encode("ascii").translate(None, _KEYNORM_ASCII_DEL).decode("ascii")
+    return _KEYNORM_RE.sub("", s)
 
 def is_audio_file(name: str) -> bool:
-    return pathlib.Path(name).suffix.lower() in SCAN_EXTS
+    i = name.rfind(".")
+    return i > 0 and name[i+1:].lower() in SCAN_EXTS_NOSEP
 
 def ensure_dir(path: str):
     d = os.path.dirname(path)
@@ -112,25 +132,36 @@ def current_slot_id() -> int:
 
 # ------------- DB -------------
 SCHEMA = """
-PRAGMA journal_mode=WAL;
-PRAGMA busy_timeout=5000;
-
 CREATE TABLE IF NOT EXISTS meta (
   key TEXT PRIMARY KEY,
   val TEXT NOT NULL
 );
 
+-- normalized artist/title keys, stored once and referenced by id from files
+CREATE TABLE IF NOT EXISTS norms (
+  id   INTEGER PRIMARY KEY,
+  text TEXT UNIQUE NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS files (
   path TEXT PRIMARY KEY,
-  mtime REAL NOT NULL,
-  artist_norm TEXT,
-  title_norm TEXT,
+  mtime INTEGER NOT NULL,  -- st_mtime_ns
+  artist_norm_id INTEGER,
+  title_norm_id INTEGER,
   artist_raw TEXT,
-  title_raw TEXT
+  title_raw TEXT,
+  tagged INTEGER NOT NULL DEFAULT 0  -- 1 if artist/title came from tags, 0 if only from the filename
 );
 
-CREATE INDEX IF NOT EXISTS idx_files_artist_norm ON files(artist_norm);
-CREATE INDEX IF NOT EXISTS idx_files_title_norm  ON files(title_norm);
+CREATE INDEX IF NOT EXISTS idx_files_artist_norm_id ON files(artist_norm_id);
+CREATE INDEX IF NOT EXISTS idx_files_title_norm_id  ON files(title_norm_id);
+
+-- files with the norm ids resolved back to text
+CREATE VIEW IF NOT EXISTS files_named AS
+  SELECT f.path, f.mtime, an.text AS artist_norm, tn.text AS title_norm, f.artist_raw, f.title_raw, f.tagged
+  FROM files f
+  LEFT JOIN norms an ON an.id = f.artist_norm_id
+  LEFT JOIN norms tn ON tn.id = f.title_norm_id;
 
 -- last on-air start time by normalized keys
 CREATE TABLE IF NOT EXISTS last_artist_play (
@@ -160,18 +191,105 @@ CREATE TABLE IF NOT EXISTS evergreen_played (
   slot_id INTEGER PRIMARY KEY,
   ts      REAL NOT NULL
 );
+
+-- every file in shuffled order, rebuilt with the cache; pick-next walks it by rowid.
+-- Integer columns only; paths and norm text are looked up via the ids.
+CREATE TABLE IF NOT EXISTS picks_pool (
+  file_id INTEGER NOT NULL,  -- files.rowid
+  artist_norm_id INTEGER,
+  title_norm_id INTEGER
+);
 """
 
-def db_connect():
+# applied on every connection; WAL lets the cache builder write while pick-next reads
+_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-64000",
+    "busy_timeout=5000",
+)
+
+# pick-next is read-heavy and runs constantly: map as much of the file as SQLite
+# allows (it clamps to its compile-time max) so reads skip pread() entirely
+_PICK_PRAGMAS = (
+    "mmap_size=30000000000",
+)
+
+def apply_pragmas(con, mode: str = "default"):
+    for p in _PRAGMAS + (_PICK_PRAGMAS if mode == "pick" else ()):
+        con.execute(f"PRAGMA {p}")
+
+def db_connect(mode: str = "default"):
     ensure_dir(DB_PATH)
     con = sqlite3.connect(DB_PATH, timeout=5, isolation_level=None)
     con.row_factory = sqlite3.Row
+    apply_pragmas(con, mode)
     return con
 
+SCHEMA_VERSION = 6  # bump whenever SCHEMA changes; stored in PRAGMA user_version
+
 def db_init(con):
+    v = con.execute("PRAGMA user_version").fetchone()[0]
+    if v < 3:
+        # v3 switched files to norm ids; the cache tables are rebuildable, so just recreate them
+        con.executescript("DROP VIEW IF EXISTS files_named; DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS picks_pool;")
+        remove_cache_stamp()
+    else:
+        if v < 4:
+            con.execute("DROP INDEX IF EXISTS idx_files_covering")  # unused by any picker query since v3
+        if v < 5:
+            # existing rows start untagged, so the next rebuild re-reads them once
+            con.executescript("ALTER TABLE files ADD COLUMN tagged INTEGER NOT NULL DEFAULT 0; DROP VIEW IF EXISTS files_named;")
+        if v < 6:
+            # picks_pool switched to ids; refilled from files below
+            con.executescript("DROP VIEW IF EXISTS files_named; DROP TABLE IF EXISTS picks_pool;")
     for stmt in SCHEMA.strip().split(";\n\n"):
         if stmt.strip():
             con.executescript(stmt + ";")
+    if 3 <= v < 6:
+        fill_picks_pool(con)
+    con.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+def fill_picks_pool(con):
+    con.execute("DELETE FROM picks_pool")
+    con.execute(
+        "INSERT INTO picks_pool(file_id, artist_norm_id, title_norm_id) SELECT rowid, artist_norm_id, title_norm_id FROM files ORDER BY random()"
+    )
+    meta_set(con, "pool_cursor", 0)
+
+def touch_cache_stamp():
+    try:
+        pathlib.Path(CACHE_STAMP).touch()
+    except OSError:
+        pass
+
+def remove_cache_stamp():
+    try:
+        os.remove(CACHE_STAMP)
+    except OSError:
+        pass
+
+def db_close(con):
+    # refresh planner stats for tables that changed, then release the connection
+    try:
+        con.execute("PRAGMA optimize")
+        con.close()
+    except Exception:
+        pass
+
+def open_db(init: bool = False, mode: str = "default"):
+    """
+    Connect and register PRAGMA optimize + close for process exit. The schema is
+    only (re)applied when asked or when the DB predates SCHEMA_VERSION, so hot
+    subcommands like pick-next skip it.
+    """
+    con = db_connect(mode)
+    if init or con.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        db_init(con)
+    atexit.register(db_close, con)
+    return con
 
 def meta_get(con, key, default=None):
     cur = con.execute("SELECT val FROM meta WHERE key=?", (key,))
@@ -182,6 +300,16 @@ def meta_set(con, key, val):
     con.execute("INSERT INTO meta(key,val) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET val=excluded.val", (key, json.dumps(val)))
 
 # ------------- TAGS -------------
+def name_fallback(path: str, artist: str, title: str):
+    base = pathlib.Path(path).stem.strip()
+    if not title:
+        title = base
+    if not artist and " - " in base:
+        a, _t = base.split(" - ", 1)
+        artist = a
+
+    return artist, title
+
 def ffprobe_tags(path: str):
     artist = ""; title = ""
     try:
@@ -189,13 +317,13 @@ def ffprobe_tags(path: str):
             [
                 "ffprobe", "-v", "error",
                 "-show_entries", "format_tags=artist,title,album_artist,albumartist,performer,AlbumArtist,ALBUMARTIST,ARTIST,TITLE,PERFORMER",
-                "-of", "json", path,
+                "-of", "default=noprint_wrappers=1", path,
             ],
             stderr=subprocess.DEVNULL, text=True, timeout=FFPROBE_TIMEOUT
         )
-        data = json.loads(out)
-        tags = (data.get("format") or {}).get("tags") or {}
-        tags_norm = { (k or "").lower(): (v or "").strip() for k, v in tags.items() }
+        # one "TAG:key=value" per line
+        tags = dict(l.split("=", 1) for l in out.splitlines() if "=" in l)
+        tags_norm = { k.lower().removeprefix("tag:"): v.strip() for k, v in tags.items() }
         for key in ("artist","albumartist","album_artist","album artist","performer"):
             v = tags_norm.get(key, "")
             if v:
@@ -204,15 +332,44 @@ def ffprobe_tags(path: str):
     except Exception:
         pass
 
-    base = pathlib.Path(path).stem.strip()
-    if not title:
-        title = base
-    if not artist and " - " in base:
-        a, _t = base.split(" - ", 1)
-        artist = a
-
     return artist, title
 
+def mutagen_tags(path: str):
+    """
+    Read tags in-process. Returns None when mutagen is missing, can't parse the
+    file, or finds no artist/title, so ffprobe gets a turn.
+    """
+    if MutagenFile is None:
+        return None
+    try:
+        m = MutagenFile(path, easy=True)
+    except Exception:
+        return None
+    # WAV/AAC come back with raw ID3 frames even with easy=True; their keys are
+    # frame ids, not "artist"/"title", so leave those files to ffprobe
+    if m is None or m.tags is None or isinstance(m.tags, MutagenID3):
+        return None
+    tags = m.tags
+    def first(key):
+        try:
+            return ((tags.get(key) or [""])[0] or "").strip()
+        except Exception:
+            return ""
+    artist = ""
+    for key in ("artist","albumartist","album_artist","performer"):
+        artist = first(key)
+        if artist:
+            break
+    title = first("title")
+    return (artist, title) if artist or title else None
+
+def raw_tags(path: str):
+    return mutagen_tags(path) or ffprobe_tags(path)
+
+def read_tags(path: str):
+    # the filename only fills in once both readers have come up empty
+    return name_fallback(path, *raw_tags(path))
+
 # ------------- SCAN / CACHE -------------
 def scan_paths(root_dir: str):
     stack = [root_dir]
@@ -223,48 +380,147 @@ def scan_paths(root_dir: str):
                 for e in it:
                     if e.is_dir(follow_symlinks=False):
                         stack.append(e.path)
-                    elif e.is_file(follow_symlinks=False) and is_audio_file(e.name):
+                    # is_audio_file inlined: this runs once per file in the library
+                    elif (i := e.name.rfind(".")) > 0 and e.name[i+1:].lower() in SCAN_EXTS_NOSEP \
+                            and e.is_file(follow_symlinks=False):
                         yield e.path
         except (PermissionError, FileNotFoundError):
             continue
 
-def refresh_cache(con):
-    # build into temp table then swap for minimal lock
-    con.execute("BEGIN IMMEDIATE")
-    try:
-        con.execute("""
-        CREATE TEMP TABLE t_new_files (
-          path TEXT PRIMARY KEY,
-          mtime REAL NOT NULL,
-          artist_norm TEXT,
-          title_norm TEXT,
-          artist_raw TEXT,
-          title_raw TEXT
-        );
-        """)
+def probe_row(p: str, mtime: int):
+    artist, title = raw_tags(p)
+    tagged = 1 if artist or title else 0
+    a_raw, t_raw = name_fallback(p, artist, title)
+    a_norm = key_norm(a_raw) or ("__unknown__" if UNKNOWN_ARTIST_BUCKET else None)
+    t_norm = key_norm(t_raw) or None
+    return (p, mtime, a_norm, t_norm, a_raw, t_raw, tagged)
 
-        for p in scan_paths(MUSIC_DIR):
+def scan_producer(root_dir: str, scan_q):
+    try:
+        for p in scan_paths(root_dir):
             try:
                 st = os.stat(p)
             except (FileNotFoundError, PermissionError):
                 continue
-            a_raw, t_raw = ffprobe_tags(p)
-            a_norm = key_norm(a_raw) or ("__unknown__" if UNKNOWN_ARTIST_BUCKET else None)
-            t_norm = key_norm(t_raw) or None
+            scan_q.put((p, st.st_mtime_ns))
+    finally:
+        scan_q.put(None)
 
-            con.execute(
-                "INSERT OR REPLACE INTO t_new_files(path, mtime, artist_norm, title_norm, artist_raw, title_raw) VALUES(?,?,?,?,?,?)",
-                (p, st.st_mtime, a_norm, t_norm, a_raw, t_raw)
-            )
+def tag_worker(scan_q, write_q, old: dict):
+    # tag reads are I/O- or subprocess-bound (ffprobe), so threads keep several in flight.
+    # Posts a full row for (re)tagged files, (path,) for unchanged ones, None when done.
+    try:
+        while True:
+            item = scan_q.get()
+            if item is None:
+                scan_q.put(None)  # pass the sentinel on to the next worker
+                break
+            p, mtime = item
+            if old.get(p) == mtime:
+                write_q.put((p,))
+                continue
+            try:
+                write_q.put(probe_row(p, mtime))
+            except Exception:
+                continue
+    finally:
+        write_q.put(None)
+
+def tag_config():
+    # settings baked into stored rows; a change forces a full re-tag
+    return {"unknown_artist_bucket": UNKNOWN_ARTIST_BUCKET}
+
+def refresh_cache(con, full: bool = False):
+    # scan and tag into a temp table first; it lives outside the main DB,
+    # so the write lock below only covers the swap
+    con.execute("DROP TABLE IF EXISTS temp.t_new_files")
+    con.execute("""
+    CREATE TEMP TABLE t_new_files (
+      path TEXT PRIMARY KEY,
+      mtime INTEGER NOT NULL,
+      artist_norm TEXT,
+      title_norm TEXT,
+      artist_raw TEXT,
+      title_raw TEXT,
+      tagged INTEGER NOT NULL
+    );
+    """)
+
+    # only new, modified or filename-only files get re-tagged; the rest are copied over
+    if full or meta_get(con, "tag_config") != tag_config():
+        old = {}
+    else:
+        old = {r[0]: r[1] for r in con.execute("SELECT path, mtime FROM files WHERE tagged")}
+
+    # t_new_files starts empty and paths are unique, so no conflict handling needed
+    rows = []; reuse = []
+    def flush():
+        con.executemany(
+            "INSERT INTO t_new_files(path, mtime, artist_norm, title_norm, artist_raw, title_raw, tagged) VALUES(?,?,?,?,?,?,?)",
+            rows
+        )
+        con.executemany(
+            "INSERT INTO t_new_files SELECT path, mtime, artist_norm, title_norm, artist_raw, title_raw, tagged FROM files_named WHERE path=?",
+            reuse
+        )
+        rows.clear(); reuse.clear()
+
+    # pipeline: scanner thread -> scan_q -> tag workers -> write_q -> this thread (sqlite)
+    workers = max(1, FFPROBE_WORKERS)
+    scan_q = queue.Queue(maxsize=SCAN_QUEUE); write_q = queue.Queue()
+    with ThreadPoolExecutor(max_workers=workers + 1) as pool:
+        producer = pool.submit(scan_producer, MUSIC_DIR, scan_q)
+        for _ in range(workers):
+            pool.submit(tag_worker, scan_q, write_q, old)
+        done = 0
+        while done < workers:
+            item = write_q.get()
+            if item is None:
+                done += 1
+            elif len(item) == 1:
+                reuse.append(item)
+            else:
+                rows.append(item)
+            if len(rows) + len(reuse) >= INSERT_BATCH:
+                flush()
+        producer.result()  # a failed scan must not swap in a partial table
+    flush()
 
+    con.execute("BEGIN IMMEDIATE")
+    try:
         # Replace old with new
         con.execute("DELETE FROM files;")
-        con.execute("INSERT INTO files SELECT * FROM t_new_files;")
+        con.execute("""
+        INSERT OR IGNORE INTO norms(text)
+          SELECT artist_norm FROM t_new_files WHERE artist_norm IS NOT NULL
+          UNION SELECT title_norm FROM t_new_files WHERE title_norm IS NOT NULL;
+        """)
+        con.execute("""
+        INSERT INTO files(path, mtime, artist_norm_id, title_norm_id, artist_raw, title_raw, tagged)
+          SELECT t.path, t.mtime, an.id, tn.id, t.artist_raw, t.title_raw, t.tagged
+          FROM t_new_files t
+          LEFT JOIN norms an ON an.text = t.artist_norm
+          LEFT JOIN norms tn ON tn.text = t.title_norm;
+        """)
+        con.execute("""
+        DELETE FROM norms WHERE id NOT IN (
+          SELECT artist_norm_id FROM files WHERE artist_norm_id IS NOT NULL
+          UNION SELECT title_norm_id FROM files WHERE title_norm_id IS NOT NULL
+        );
+        """)
+        fill_picks_pool(con)
+        meta_set(con, "tag_config", tag_config())
         meta_set(con, "generated_at", now_ts())
         con.execute("COMMIT")
     except Exception:
         con.execute("ROLLBACK")
         raise
+    # an empty scan (e.g. MUSIC_DIR unmounted) must not mark the cache fresh
+    if con.execute("SELECT 1 FROM files LIMIT 1").fetchone():
+        touch_cache_stamp()
+    else:
+        remove_cache_stamp()
+    con.execute("ANALYZE")
 
 # ------------- LOCK -------------
 def try_acquire_lock(con, name: str, stale_sec: int) -> bool:
@@ -295,55 +551,66 @@ def release_lock(con, name: str):
         pass
 
 # ------------- HISTORY / SEPARATION -------------
-def too_recent(con, artist_norm: str, title_norm: str, path: str) -> bool:
-    now = now_ts()
-    if artist_norm:
-        r = con.execute("SELECT ts FROM last_artist_play WHERE artist_norm=?", (artist_norm,)).fetchone()
-        if r and (now - float(r["ts"]) < ARTIST_SEP): return True
-    if title_norm:
-        r = con.execute("SELECT ts FROM last_title_play WHERE title_norm=?", (title_norm,)).fetchone()
-        if r and (now - float(r["ts"]) < TITLE_SEP): return True
-    if TRACK_SEP and path:
-        r = con.execute("SELECT ts FROM last_path_play WHERE path=?", (path,)).fetchone()
-        if r and (now - float(r["ts"]) < TRACK_SEP): return True
-    return False
-
-def violation_score(con, artist_norm: str, title_norm: str, path: str) -> float:
-    now = now_ts()
-    def age(table, keycol, keyval):
-        if not keyval: return 10**9
-        r = con.execute(f"SELECT ts FROM {table} WHERE {keycol}=?", (keyval,)).fetchone()
-        return now - float(r["ts"]) if r else 10**9
-    sa = age("last_artist_play","artist_norm",artist_norm)
-    st = age("last_title_play","title_norm",title_norm)
-    sp = age("last_path_play","path",path) if TRACK_SEP else 10**9
-    return min(sa, st, sp)
-
-def stamp_selection(con, path: str, artist_norm: str, title_norm: str):
-    now = now_ts()
-    if artist_norm:
-        con.execute("INSERT INTO last_artist_play(artist_norm, ts) VALUES(?,?) ON CONFLICT(artist_norm) DO UPDATE SET ts=excluded.ts", (artist_norm, now))
-    if title_norm:
-        con.execute("INSERT INTO last_title_play(title_norm, ts) VALUES(?,?) ON CONFLICT(title_norm) DO UPDATE SET ts=excluded.ts", (title_norm, now))
-    if TRACK_SEP and path:
-        con.execute("INSERT INTO last_path_play(path, ts) VALUES(?,?) ON CONFLICT(path) DO UPDATE SET ts=excluded.ts", (path, now))
+def separation_sql(now: float):
+    """
+    Build the joins from picks_pool (aliased f) through norms to the history
+    tables, plus two SQL fragments over them: a WHERE clause
+    that keeps only rows clear of every separation window, and an ORDER BY
+    expression for the age of a row's most recent conflicting play (larger is
+    better; 1e9 when never played). Returns (joins, ok, ok_params, age, age_params).
+    """
+    joins = ("LEFT JOIN norms an ON an.id = f.artist_norm_id "
+             "LEFT JOIN norms tn ON tn.id = f.title_norm_id "
+             "LEFT JOIN last_artist_play a ON a.artist_norm = an.text "
+             "LEFT JOIN last_title_play t ON t.title_norm = tn.text")
+    ok = "(a.ts IS NULL OR ? - a.ts >= ?) AND (t.ts IS NULL OR ? - t.ts >= ?)"
+    ok_params = [now, ARTIST_SEP, now, TITLE_SEP]
+    age = "min(coalesce(? - a.ts, 1e9), coalesce(? - t.ts, 1e9)"
+    age_params = [now, now]
+    if TRACK_SEP:
+        joins += " JOIN files fl ON fl.rowid = f.file_id LEFT JOIN last_path_play p ON p.path = fl.path"
+        ok += " AND (p.ts IS NULL OR ? - p.ts >= ?)"
+        ok_params += [now, TRACK_SEP]
+        age += ", coalesce(? - p.ts, 1e9)"
+        age_params.append(now)
+    return joins, ok, ok_params, age + ")", age_params
+
+PRUNE_EVERY = 100  # history trims re-sort whole tables, so only run them every Nth write
+
+def prune_history(con):
+    n = int(meta_get(con, "prune_counter", 0) or 0) + 1
+    meta_set(con, "prune_counter", n)
+    if n % PRUNE_EVERY:
+        return
     con.execute("DELETE FROM last_artist_play WHERE rowid NOT IN (SELECT rowid FROM last_artist_play ORDER BY ts DESC LIMIT ?)", (HISTORY_KEEP,))
     con.execute("DELETE FROM last_title_play  WHERE rowid NOT IN (SELECT rowid FROM last_title_play  ORDER BY ts DESC LIMIT ?)", (HISTORY_KEEP,))
     con.execute("DELETE FROM last_path_play   WHERE rowid NOT IN (SELECT rowid FROM last_path_play   ORDER BY ts DESC LIMIT ?)", (HISTORY_KEEP_PATHS,))
 
+def stamp_history(con, artist_norm: str, title_norm: str, path: str, pool_cursor=None):
+    now = now_ts()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        if artist_norm:
+            con.execute("INSERT INTO last_artist_play(artist_norm, ts) VALUES(?,?) ON CONFLICT(artist_norm) DO UPDATE SET ts=excluded.ts", (artist_norm, now))
+        if title_norm:
+            con.execute("INSERT INTO last_title_play(title_norm, ts) VALUES(?,?) ON CONFLICT(title_norm) DO UPDATE SET ts=excluded.ts", (title_norm, now))
+        if path:
+            con.execute("INSERT INTO last_path_play(path, ts) VALUES(?,?) ON CONFLICT(path) DO UPDATE SET ts=excluded.ts", (path, now))
+        if pool_cursor is not None:
+            meta_set(con, "pool_cursor", pool_cursor)
+        prune_history(con)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+def stamp_selection(con, path: str, artist_norm: str, title_norm: str, pool_cursor=None):
+    stamp_history(con, artist_norm, title_norm, path if TRACK_SEP else "", pool_cursor)
+
 def track_start(con, artist: str, title: str, path: str):
     a_norm = key_norm(artist) or ("__unknown__" if UNKNOWN_ARTIST_BUCKET else None)
     t_norm = key_norm(title) or None
-    now = now_ts()
-    if a_norm:
-        con.execute("INSERT INTO last_artist_play(artist_norm, ts) VALUES(?,?) ON CONFLICT(artist_norm) DO UPDATE SET ts=excluded.ts", (a_norm, now))
-    if t_norm:
-        con.execute("INSERT INTO last_title_play(title_norm, ts) VALUES(?,?) ON CONFLICT(title_norm) DO UPDATE SET ts=excluded.ts", (t_norm, now))
-    if path:
-        con.execute("INSERT INTO last_path_play(path, ts) VALUES(?,?) ON CONFLICT(path) DO UPDATE SET ts=excluded.ts", (path, now))
-    con.execute("DELETE FROM last_artist_play WHERE rowid NOT IN (SELECT rowid FROM last_artist_play ORDER BY ts DESC LIMIT ?)", (HISTORY_KEEP,))
-    con.execute("DELETE FROM last_title_play  WHERE rowid NOT IN (SELECT rowid FROM last_title_play  ORDER BY ts DESC LIMIT ?)", (HISTORY_KEEP,))
-    con.execute("DELETE FROM last_path_play   WHERE rowid NOT IN (SELECT rowid FROM last_path_play   ORDER BY ts DESC LIMIT ?)", (HISTORY_KEEP_PATHS,))
+    stamp_history(con, a_norm, t_norm, path)
 
 # ------------- EVERGREEN -------------
 def pick_evergreen() -> str:
@@ -373,23 +640,37 @@ def mark_slot_served(con, slot_id: int):
     con.execute("DELETE FROM evergreen_played WHERE rowid NOT IN (SELECT rowid FROM evergreen_played ORDER BY ts DESC LIMIT 200)")
 
 # ------------- PICKING -------------
-def pick_from_cache(con):
-    rows = con.execute("SELECT path, artist_norm, title_norm FROM files ORDER BY random() LIMIT 2000").fetchall()
-    if not rows:
-        return None
+PICK_SAMPLE = 2000
 
-    # Strict pass
-    for r in rows:
-        if not too_recent(con, r["artist_norm"], r["title_norm"], r["path"]):
-            return r
+def pick_candidate(con, scope: str, scope_params: list, now: float):
+    joins, ok, ok_params, age, age_params = separation_sql(now)
+    base = f"SELECT f.file_id, an.text AS artist_norm, tn.text AS title_norm FROM picks_pool f {joins} WHERE {scope}"
 
-    # Least-violating
-    best = None; best_score = -1.0
-    for r in rows:
-        sc = violation_score(con, r["artist_norm"], r["title_norm"], r["path"])
-        if sc > best_score:
-            best, best_score = r, sc
-    return best
+    # Strict pass, then least-violating
+    r = con.execute(f"{base} AND {ok} ORDER BY random() LIMIT 1", scope_params + ok_params).fetchone()
+    if r is None:
+        r = con.execute(f"{base} ORDER BY {age} DESC, random() LIMIT 1", scope_params + age_params).fetchone()
+    if r is None:
+        return None
+    # only the winner needs its path
+    path = con.execute("SELECT path FROM files WHERE rowid=?", (r["file_id"],)).fetchone()
+    return {"path": path["path"], "artist_norm": r["artist_norm"], "title_norm": r["title_norm"]} if path else None
+
+def pick_from_pool(con, now: float):
+    # picks_pool is already shuffled, so each pick takes the next window of rows
+    pool_n = con.execute("SELECT max(rowid) FROM picks_pool").fetchone()[0] or 0
+    if not pool_n:
+        return None
+    cur = int(meta_get(con, "pool_cursor", 0) or 0)
+    if cur >= pool_n:
+        cur = 0
+    r = pick_candidate(con, "f.rowid > ? AND f.rowid <= ?", [cur, cur + PICK_SAMPLE], now)
+    if r:
+        r["pool_cursor"] = cur + PICK_SAMPLE  # saved by stamp_selection, in the same write
+    return r
+
+def pick_from_cache(con):
+    return pick_from_pool(con, now_ts())
 
 def quick_random_dart():
     # 1) top-level
@@ -398,8 +679,8 @@ def quick_random_dart():
             entries = [e for e in it]
     except Exception:
         entries = []
-    random.shuffle(entries)
-    entries = entries[:TOP_N_DIRS] if TOP_N_DIRS > 0 else entries
+    # random.sample returns its picks in random order, so no separate shuffle is needed
+    entries = random.sample(entries, min(TOP_N_DIRS, len(entries)) if TOP_N_DIRS > 0 else len(entries))
 
     files = [e.path for e in entries if e.is_file(follow_symlinks=False) and is_audio_file(e.name)]
     if files:
@@ -407,7 +688,6 @@ def quick_random_dart():
 
     # 2) peek into a few dirs
     dirs = [e for e in entries if e.is_dir(follow_symlinks=False)]
-    random.shuffle(dirs)
     for d in dirs:
         try:
             with os.scandir(d.path) as it:
@@ -415,8 +695,7 @@ def quick_random_dart():
         except Exception:
             continue
         if fs:
-            random.shuffle(fs)
-            return fs[0 if len(fs) == 1 else min(len(fs)-1, os.urandom(1)[0] % min(len(fs), FILES_PER_DIR_TRY))]
+            return random.choice(fs)
 
     # 3) shallow walk
     for p in scan_paths(MUSIC_DIR):
@@ -424,6 +703,13 @@ def quick_random_dart():
     return None
 
 def ensure_fresh_cache_async(con):
+    # one stat() instead of two queries; falls through to meta when the stamp is missing or old
+    try:
+        if (now_ts() - os.stat(CACHE_STAMP).st_mtime) <= RE_SCAN_SEC:
+            return
+    except OSError:
+        pass
+
     gen = meta_get(con, "generated_at", 0) or 0
     if (now_ts() - float(gen)) <= RE_SCAN_SEC and con.execute("SELECT 1 FROM files LIMIT 1").fetchone():
         return  # fresh enough
@@ -431,27 +717,19 @@ def ensure_fresh_cache_async(con):
     if not try_acquire_lock(con, "cache_builder", LOCK_STALE):
         return
 
+    # detached child with its own connection; it releases the lock when done
     try:
-        pid = os.fork()
-    except Exception:
-        release_lock(con, "cache_builder")
-        return
-
-    if pid != 0:
-        return
-
-    # child process
-    try:
-        refresh_cache(con)
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "rebuild-cache", "--release-lock"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
     except Exception:
-        pass
-    finally:
         release_lock(con, "cache_builder")
-        os._exit(0)
 
 # ------------- CLI -------------
 def cmd_pick_next():
-    con = db_connect(); db_init(con)
+    con = open_db(mode="pick")
     ensure_fresh_cache_async(con)
 
     # Evergreen slot check: if we're within the window of a quarter-hour boundary
@@ -469,7 +747,7 @@ def cmd_pick_next():
     r = pick_from_cache(con)
     if r:
         path = r["path"]
-        stamp_selection(con, path, r["artist_norm"], r["title_norm"])
+        stamp_selection(con, path, r["artist_norm"], r["title_norm"], r["pool_cursor"])
         print(path, end="")
         return
 
@@ -477,7 +755,7 @@ def cmd_pick_next():
     p = quick_random_dart()
     if p:
         try:
-            a_raw, t_raw = ffprobe_tags(p)
+            a_raw, t_raw = read_tags(p)
             a_norm = key_norm(a_raw) or ("__unknown__" if UNKNOWN_ARTIST_BUCKET else None)
             t_norm = key_norm(t_raw) or None
             stamp_selection(con, p, a_norm, t_norm)
@@ -490,18 +768,27 @@ def cmd_pick_next():
     print("", end="")
 
 def cmd_track_start(args):
-    con = db_connect(); db_init(con)
+    con = open_db()
     track_start(con, args.artist or "", args.title or "", args.path or "")
 
-def cmd_rebuild_cache():
-    con = db_connect(); db_init(con)
-    refresh_cache(con)
+def cmd_rebuild_cache(args):
+    con = None
+    try:
+        con = open_db(init=True)
+        refresh_cache(con, full=args.full)
+    finally:
+        if args.release_lock:
+            # if opening the DB is what failed, retry on a plain connection
+            try:
+                release_lock(con or db_connect(), "cache_builder")
+            except Exception:
+                pass
 
 def cmd_init():
-    con = db_connect(); db_init(con)
+    con = open_db(init=True)
 
 def cmd_vacuum():
-    con = db_connect(); db_init(con)
+    con = open_db()
     con.execute("VACUUM")
 
 def main():
@@ -515,14 +802,16 @@ def main():
     ap_ts.add_argument("--title",  default="", help="title (raw)")
     ap_ts.add_argument("--path",   default="", help="full file path")
 
-    sub.add_parser("rebuild-cache")
+    ap_rc = sub.add_parser("rebuild-cache")
+    ap_rc.add_argument("--full", action="store_true", help="re-read tags for every file, not just new or changed ones")
+    ap_rc.add_argument("--release-lock", action="store_true", help="release the cache_builder lock when done (used by pick-next)")
     sub.add_parser("init")
     sub.add_parser("vacuum")
 
     args = ap.parse_args()
     if args.cmd == "pick-next":      cmd_pick_next()
     elif args.cmd == "track-start":  cmd_track_start(args)
-    elif args.cmd == "rebuild-cache":cmd_rebuild_cache()
+    elif args.cmd == "rebuild-cache":cmd_rebuild_cache(args)
     elif args.cmd == "init":         cmd_init()
     elif args.cmd == "vacuum":       cmd_vacuum()
 